@@ -1,19 +1,108 @@
 # pip install pytelegrambotapi
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import telebot
-from telebot import types
+from telebot import types, apihelper
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
+import csv
+import hashlib
+import heapq
 import json
+import logging
 import os
+import signal
+import sys
+import tempfile
 import time
 import random  # 💥 для крит-кликов и немного рандома
+import sqlite3
+import threading
+from collections import Counter, OrderedDict
+from logging.handlers import RotatingFileHandler
 
 # ================== НАСТРОЙКИ ==================
 TOKEN = os.getenv("BOT_TOKEN")
 
-DATA_FILE = "game_data.json"
+DATA_FILE = os.getenv("DATA_FILE", "game_data.json")       # старый формат: теперь только для миграции
+PLAYER_DB_FILE = os.getenv("PLAYER_DB_FILE", "game_data.db")  # хранилище всех игроков на диске
+
+# 📼 ЗАПИСЬ АПДЕЙТОВ для реплея (python replay.py updates.log)
+UPDATE_LOG_FILE = os.getenv("UPDATE_LOG_FILE")  # не задан — не пишем
+UPDATE_LOG_MAX_BYTES = int(os.getenv("UPDATE_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+UPDATE_LOG_BACKUPS = int(os.getenv("UPDATE_LOG_BACKUPS", "5"))
+
+# 🧊 КЭШ ИГРОКОВ: в памяти держим только активных
+PLAYER_CACHE_SIZE = int(os.getenv("PLAYER_CACHE_SIZE", "1000"))       # максимум игроков в памяти
+PLAYER_CACHE_IDLE_TTL = int(os.getenv("PLAYER_CACHE_IDLE_TTL", "1800"))  # выгружать после 30 минут тишины
+
+# 🚦 АНТИФЛУД: корзина токенов на игрока, отдельно для каждого вида запросов
+FLOOD_CONTROL_ENABLED = os.getenv("FLOOD_CONTROL", "1") != "0"
+FLOOD_LIMITS = {
+    # вид: (токенов в секунду, размер корзины, политика "drop" / "merge" / "warn")
+    "click": (
+        float(os.getenv("FLOOD_CLICK_RATE", "3")),
+        int(os.getenv("FLOOD_CLICK_BURST", "6")),
+        os.getenv("FLOOD_CLICK_POLICY", "merge"),
+    ),
+    "callback": (
+        float(os.getenv("FLOOD_CALLBACK_RATE", "2")),
+        int(os.getenv("FLOOD_CALLBACK_BURST", "5")),
+        os.getenv("FLOOD_CALLBACK_POLICY", "warn"),
+    ),
+    "heavy": (
+        float(os.getenv("FLOOD_HEAVY_RATE", "0.1")),
+        int(os.getenv("FLOOD_HEAVY_BURST", "2")),
+        os.getenv("FLOOD_HEAVY_POLICY", "warn"),
+    ),
+    "other": (
+        float(os.getenv("FLOOD_OTHER_RATE", "1")),
+        int(os.getenv("FLOOD_OTHER_BURST", "5")),
+        os.getenv("FLOOD_OTHER_POLICY", "warn"),
+    ),
+}
+FLOOD_MAX_BUCKETS = 50000  # чтобы корзины давно ушедших игроков не копились вечно
+CLICK_COMMANDS = {"/click", "Кликнуть 💰"}
+HEAVY_COMMANDS = {"/leaderboard", "Лидерборд 🏆", "/export"}
+
+# 🏆 ЛИДЕРБОРД
+LEADERBOARD_PAGE_SIZE = 10
+
+# ✏️ ПРАВКИ СООБЩЕНИЙ: делаем после ответа на кнопку, частые нажатия склеиваем
+EDIT_DEBOUNCE = float(os.getenv("EDIT_DEBOUNCE", "0.4"))  # секунд ждём последнее нажатие
+EDIT_HASH_CACHE_SIZE = 10000  # сколько сообщений помним, чтобы не слать одинаковые правки
+
+# 🌐 СВЯЗЬ С TELEGRAM: общий пул keep-alive соединений, таймауты и повторы
+# адрес Bot API; для нагрузочных тестов: TELEGRAM_API_URL=http://127.0.0.1:8081 (fake_telegram_api.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+BOT_NUM_THREADS = int(os.getenv("BOT_NUM_THREADS", "4"))  # потоков-обработчиков у telebot
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(BOT_NUM_THREADS + 4)))  # + поллинг и фоновые таймеры
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.3"))  # секунд, удваивается с каждой попыткой
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "5"))
+# эти методы можно безопасно повторить, даже если Telegram мог успеть их выполнить
+HTTP_IDEMPOTENT_METHODS = {
+    "getUpdates", "getMe", "answerCallbackQuery", "editMessageText", "editMessageReplyMarkup",
+}
+
+# 🚀 СТАРТ: что делать с очередью апдейтов, накопившейся, пока бот лежал
+ALLOWED_UPDATES = ["message", "callback_query"]  # только то, что мы обрабатываем
+STARTUP_STALE_AFTER = int(os.getenv("STARTUP_STALE_AFTER", "60"))  # сообщения старше (сек) — устаревшие
+STARTUP_STALE_CLICKS = os.getenv("STARTUP_STALE_CLICKS", "merge")       # merge — засчитать пачкой / drop
+STARTUP_STALE_MESSAGES = os.getenv("STARTUP_STALE_MESSAGES", "drop")    # drop / process
+STARTUP_STALE_CALLBACKS = os.getenv("STARTUP_STALE_CALLBACKS", "answer")  # answer — молча погасить / drop / process
+STARTUP_BATCH_SIZE = 100  # максимум, который Telegram отдаёт за один getUpdates
+OFFSET_SAVE_INTERVAL = 5  # секунд между сохранениями offset поллинга (и отметки «бот жив»)
+
+# 🛠 АДМИНЫ (id через запятую), им доступны служебные команды
+ADMIN_IDS = {x.strip() for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
 
 CHARACTERS = ["Гитин", "Abus", "Махач", "Джамал", "Азамат", "Омаров", "Зайпа"]
 MAX_LEVEL_PER_CHAR = 10
+LEVEL_COST_CHAR_FACTOR = 1.2  # каждый следующий персонаж дороже на 20%
 
 MAX_EARN_UPGRADE = 25
 LATYAO_DURATION = 5 * 60  # 5 минут в секундах
@@ -70,30 +159,387 @@ ACHIEVEMENTS_DEFS = {
 #      (1-й = 250, 2-й = 500, 3-й = 750 и т.д.)
 
 
+log = logging.getLogger("abu_bandit")
+
+# ⏱ Игровое время берём только отсюда, чтобы реплей мог подставить виртуальные часы
+clock = time.time
+
+
 # ================== ХРАНЕНИЕ ДАННЫХ ==================
 
-user_data = {}  # {str(user_id): {...}}
+class PlayerCache:
+    """LRU-кэш активных игроков поверх SQLite.
+
+    Снаружи ведёт себя как словарь {str(user_id): {...}}, поэтому обработчики
+    работают с ним так же, как раньше с user_data. Горячие записи живут в памяти,
+    холодные — только на диске и подгружаются при следующем сообщении игрока.
+
+    Игроков, которых держит ещё не закончившийся обработчик, не вытесняем: иначе
+    его дальнейшие изменения ушли бы в словарь, которого больше нет в кэше.
+    Обработчик отпускает игроков через release() (это делает ReleasePlayers).
+    """
+
+    def __init__(self, db_path, capacity, idle_ttl=0, on_write=None):
+        self.capacity = max(1, capacity)
+        self.idle_ttl = idle_ttl
+        self.on_write = on_write    # вызывается с (uid, данные) для каждой записи на диск
+        self._lock = threading.RLock()
+        self._hot = OrderedDict()   # uid -> данные игрока, в порядке последнего обращения
+        self._touched = {}          # uid -> время последнего обращения
+        self._saved_hash = {}       # uid -> хэш последней записанной версии
+        self._held = threading.local()  # игроки, которых держит текущий обработчик этого потока
+        self._in_use = Counter()    # uid -> сколько обработчиков его сейчас держат
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS players (uid TEXT PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        # сила игроков для лидерборда (calculate_power) и индекс по ней: место и страницы
+        # считает база, а не отсортированный список всех игроков в памяти
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ranks (uid TEXT PRIMARY KEY, best_char INTEGER NOT NULL, "
+            "best_level INTEGER NOT NULL, total_levels INTEGER NOT NULL, coins INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ranks_order "
+            "ON ranks (best_char, best_level, total_levels, coins, uid)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_players "
+            "(chat_id TEXT NOT NULL, uid TEXT NOT NULL, PRIMARY KEY (chat_id, uid)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        # метрики
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+
+    # ----- словарный интерфейс -----
+
+    def get(self, uid, default=None):
+        with self._lock:
+            user = self._hot.get(uid)
+            if user is not None:
+                self.hits += 1
+                self._hot.move_to_end(uid)
+            else:
+                self.misses += 1
+                row = self._conn.execute(
+                    "SELECT data FROM players WHERE uid = ?", (uid,)
+                ).fetchone()
+                if row is None:
+                    return default
+                user = json.loads(row[0])
+                self._hot[uid] = user
+                self._saved_hash[uid] = hash(row[0])
+            self._touched[uid] = time.monotonic()
+            self._hold(uid)
+            self._evict_overflow()
+            return user
+
+    def peek(self, uid):
+        """Читает игрока без подъёма в кэш (для лидерборда и прочих обходов)."""
+        with self._lock:
+            user = self._hot.get(uid)
+            if user is not None:
+                return user
+            row = self._conn.execute(
+                "SELECT data FROM players WHERE uid = ?", (uid,)
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+
+    def __getitem__(self, uid):
+        user = self.get(uid)
+        if user is None:
+            raise KeyError(uid)
+        return user
+
+    def __setitem__(self, uid, user):
+        with self._lock:
+            self._hot[uid] = user
+            self._hot.move_to_end(uid)
+            self._touched[uid] = time.monotonic()
+            self._hold(uid)
+            # нового игрока сразу пишем на диск, чтобы len() и обходы его видели
+            self._write([uid])
+            self._evict_overflow()
+
+    def __contains__(self, uid):
+        # только проверка: в кэш не поднимаем и в hit rate не считаем — для этого есть get()
+        with self._lock:
+            if uid in self._hot:
+                return True
+            return self._conn.execute(
+                "SELECT 1 FROM players WHERE uid = ?", (uid,)
+            ).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM players").fetchone()[0]
+
+    def __bool__(self):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM players LIMIT 1").fetchone() is not None
+
+    def iter_snapshot(self):
+        """Потоково отдаёт (uid, данные) из согласованного снимка базы.
+
+        Сначала сбрасываем грязных игроков, потом читаем через отдельное соединение
+        в одной транзакции: благодаря WAL обработчики продолжают писать, а мы видим
+        базу на момент начала чтения. Вторую копию всех игроков в памяти не держим.
+        """
+        self.flush()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute("BEGIN")
+            for uid, data in conn.execute("SELECT uid, data FROM players ORDER BY uid"):
+                yield uid, json.loads(data)
+        finally:
+            conn.close()
+
+    # ----- запись и вытеснение -----
+
+    def _held_uids(self):
+        held = getattr(self._held, "uids", None)
+        if held is None:
+            held = self._held.uids = set()
+        return held
+
+    def _hold(self, uid):
+        held = self._held_uids()
+        if uid not in held:
+            held.add(uid)
+            self._in_use[uid] += 1
+
+    def _write(self, uids):
+        """Пишет тех из uids, кто изменился с прошлой записи (сравниваем по хэшу JSON)."""
+        rows = []
+        for uid in uids:
+            user = self._hot.get(uid)
+            if user is None:
+                continue
+            data = json.dumps(user, ensure_ascii=False)
+            data_hash = hash(data)
+            if self._saved_hash.get(uid) == data_hash:
+                continue
+            rows.append((uid, data))
+            self._saved_hash[uid] = data_hash
+        if not rows:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO players (uid, data) VALUES (?, ?)", rows
+            )
+        self.writes += len(rows)
+        if self.on_write is not None:
+            for uid, _ in rows:
+                self.on_write(uid, self._hot[uid])
+
+    def _evict(self, uid):
+        self._write([uid])
+        del self._hot[uid]
+        self._saved_hash.pop(uid, None)
+        self._touched.pop(uid, None)
+        self.evictions += 1
+
+    def _evict_overflow(self):
+        overflow = len(self._hot) - self.capacity
+        if overflow <= 0:
+            return
+        # в OrderedDict самые давние обращения идут первыми; занятых обработчиками
+        # пропускаем — если заняты все, кэш ненадолго вырастет сверх capacity
+        for uid in list(self._hot):
+            if overflow <= 0:
+                break
+            if uid not in self._in_use:
+                self._evict(uid)
+                overflow -= 1
+
+    def _evict_idle(self):
+        if not self.idle_ttl:
+            return
+        deadline = time.monotonic() - self.idle_ttl
+        for uid in list(self._hot):
+            if self._touched.get(uid, 0) > deadline:
+                break
+            if uid not in self._in_use:
+                self._evict(uid)
+
+    def flush(self):
+        """Записывает изменённых игроков этого потока и выгружает неактивных.
+
+        Игроков меняют только обработчики, и каждый зовёт save_data() в своём потоке,
+        поэтому проверять нужно лишь тех, кого держит этот поток. Флаг «грязный» при
+        обращении не годится: ensure_user сохраняет игрока до того, как обработчик
+        начислит монеты.
+        """
+        with self._lock:
+            self._write(list(self._held_uids()))
+            self._evict_idle()
+
+    def release(self):
+        """Конец обработчика: сохраняет его игроков и разрешает их вытеснять."""
+        with self._lock:
+            held = self._held_uids()
+            self._write(list(held))
+            for uid in held:
+                self._in_use[uid] -= 1
+                if self._in_use[uid] <= 0:
+                    del self._in_use[uid]
+            held.clear()
+            self._evict_overflow()
+            self._evict_idle()
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value))
+            )
+
+    # ----- лидерборд -----
+
+    def set_ranks(self, entries):
+        """Запоминает (uid, calculate_power, чаты игрока) одной транзакцией."""
+        with self._lock, self._conn:
+            for uid, power, chats in entries:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO ranks (uid, best_char, best_level, total_levels, coins) "
+                    "VALUES (?, ?, ?, ?, ?)", (uid, *power),
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO chat_players (chat_id, uid) VALUES (?, ?)",
+                    ((chat_id, uid) for chat_id in chats),
+                )
+
+    @staticmethod
+    def _rank_scope(chat_id):
+        """FROM и WHERE для общего лидерборда (chat_id=None) или лидерборда чата."""
+        if chat_id is None:
+            return "ranks r WHERE 1", ()
+        return "ranks r JOIN chat_players c ON c.uid = r.uid WHERE c.chat_id = ?", (chat_id,)
+
+    def rank_count(self, chat_id=None):
+        source, params = self._rank_scope(chat_id)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {source}", params).fetchone()[0]
+
+    def rank_of(self, uid, chat_id=None):
+        """Место игрока, начиная с 0, или None, если его нет в лидерборде.
+
+        Считаем тех, кто сильнее, проходом по индексу ranks_order: это O(место), а не
+        O(log N), как было бы с деревом порядковой статистики в памяти, зато в памяти
+        нет ни одного ключа. На миллионе игроков худший случай — десятки миллисекунд.
+        """
+        source, params = self._rank_scope(chat_id)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT r.best_char, r.best_level, r.total_levels, r.coins FROM {source} AND r.uid = ?",
+                (*params, uid),
+            ).fetchone()
+            if row is None:
+                return None
+            # при равной силе выше тот, у кого uid больше, — так совпадает с rank_page
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM {source} "
+                "AND (r.best_char, r.best_level, r.total_levels, r.coins, r.uid) > (?, ?, ?, ?, ?)",
+                (*params, *row, uid),
+            ).fetchone()[0]
+
+    def rank_page(self, start, count, chat_id=None):
+        source, params = self._rank_scope(chat_id)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT r.uid FROM {source} ORDER BY r.best_char DESC, r.best_level DESC, "
+                "r.total_levels DESC, r.coins DESC, r.uid DESC LIMIT ? OFFSET ?",
+                (*params, count, start),
+            ).fetchall()
+        return [uid for uid, in rows]
+
+    def import_players(self, players):
+        """Разовая миграция из старого game_data.json."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO players (uid, data) VALUES (?, ?)",
+                ((uid, json.dumps(u, ensure_ascii=False)) for uid, u in players.items()),
+            )
 
+    def close(self):
+        with self._lock:
+            self._conn.close()
 
-def load_data():
+    def metrics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._hot),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "writes": self.writes,
+            }
+
+
+class ReleasePlayers(BaseMiddleware):
+    """После каждого апдейта отпускает игроков, которых брал обработчик (даже если он упал)."""
+
+    update_types = ["message", "callback_query"]
+
+    def pre_process(self, obj, data):
+        pass
+
+    def post_process(self, obj, data, exception):
+        try:
+            user_data.release()
+        except Exception:
+            log.exception("Не удалось сохранить игроков")
+
+
+user_data = None  # PlayerCache: {str(user_id): {...}}
+
+
+def open_player_store(on_write=None):
     global user_data
-    if os.path.exists(DATA_FILE):
+    user_data = PlayerCache(
+        PLAYER_DB_FILE, PLAYER_CACHE_SIZE, PLAYER_CACHE_IDLE_TTL, on_write=on_write
+    )
+    # переносим старых игроков из JSON, если база ещё пустая
+    if not user_data and os.path.exists(DATA_FILE):
         try:
             with open(DATA_FILE, "r", encoding="utf-8") as f:
-                user_data = json.load(f)
+                user_data.import_players(json.load(f))
         except Exception:
-            user_data = {}
-    else:
-        user_data = {}
+            log.exception("Не удалось перенести игроков из %s", DATA_FILE)
+
+
+def load_data():
+    open_player_store(on_write=index_player)
+    # ранги лежат в базе и обновляются при каждой записи игрока; пересчитываем их, только
+    # если база без них (первый запуск после обновления или перенос из JSON)
+    if user_data.rank_count() != len(user_data):
+        user_data.set_ranks(
+            (uid, calculate_power(user), user.get("chats", []))
+            for uid, user in user_data.iter_snapshot()
+        )
 
 
 def save_data():
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        user_data.flush()
     except Exception:
-        # в бою лучше логировать ошибку
-        pass
+        log.exception("Не удалось сохранить игроков")
 
 
 def get_user_id(message_or_call):
@@ -102,6 +548,10 @@ def get_user_id(message_or_call):
     return str(message_or_call.message.from_user.id)
 
 
+def is_admin(message_or_call):
+    return get_user_id(message_or_call) in ADMIN_IDS
+
+
 def get_display_name(telegram_user):
     return telegram_user.first_name or telegram_user.username or f"Игрок_{telegram_user.id}"
 
@@ -109,40 +559,48 @@ def get_display_name(telegram_user):
 def ensure_user(message):
     """Создаёт запись пользователя, если её ещё нет, и добавляет новые поля для старых."""
     uid = get_user_id(message)
-    if uid not in user_data:
-        user_data[uid] = {
+    user = user_data.get(uid)
+    if user is None:
+        user = user_data[uid] = {
             "coins": 0,
             "levels": [0] * len(CHARACTERS),
             "current_char": 0,
             "earn_upgrade": 0,
             "latyao_until": 0,
             "name": get_display_name(message.from_user),
-            "created_at": time.time(),
+            "created_at": clock(),
+            "last_seen": clock(),
             # 🎁 Ежедневный бонус
             "last_daily": 0,
             "daily_streak": 0,
             # 🏅 Достижения
             "achievements": [],
+            # 💬 Группы, где игрок играл (для лидерборда чата)
+            "chats": [],
         }
-        save_data()
     else:
-        u = user_data[uid]
         name_now = get_display_name(message.from_user)
-        if u.get("name") != name_now:
-            u["name"] = name_now
+        if user.get("name") != name_now:
+            user["name"] = name_now
         # гарантируем наличие новых полей у старых игроков
-        u.setdefault("last_daily", 0)
-        u.setdefault("daily_streak", 0)
-        u.setdefault("achievements", [])
-        save_data()
-
-    return user_data[uid]
+        user.setdefault("last_daily", 0)
+        user.setdefault("daily_streak", 0)
+        user.setdefault("achievements", [])
+        user.setdefault("chats", [])
+        user["last_seen"] = clock()
+
+    if message.chat.type in ("group", "supergroup"):
+        chat_id = str(message.chat.id)
+        if chat_id not in user["chats"]:
+            user["chats"].append(chat_id)
+    save_data()
+    return user
 
 
 # ================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ИГРЫ ==================
 
 def is_latyao_active(user):
-    return time.time() < user.get("latyao_until", 0)
+    return clock() < user.get("latyao_until", 0)
 
 
 def get_base_earn_per_click(user):
@@ -163,7 +621,7 @@ def get_effective_earn_per_click(user):
 
 def get_level_cost(char_index: int, next_level: int) -> int:
     base_first_char = 1500 + (next_level - 1) * 500
-    factor = 1.2 ** char_index
+    factor = LEVEL_COST_CHAR_FACTOR ** char_index
     return int(base_first_char * factor)
 
 
@@ -213,7 +671,7 @@ def format_stats(user):
 
     latyao_str = "нет"
     if is_latyao_active(user):
-        left = int(user["latyao_until"] - time.time())
+        left = int(user["latyao_until"] - clock())
         if left < 0:
             left = 0
         minutes = left // 60
@@ -255,6 +713,13 @@ def main_menu_keyboard():
     return kb
 
 
+# ================== ЛИДЕРБОРД: ИНДЕКС РАНГОВ ==================
+
+def index_player(uid, user):
+    """Обновляет силу игрока в таблице рангов — для общего лидерборда и лидербордов его чатов."""
+    user_data.set_ranks([(uid, calculate_power(user), user.get("chats", []))])
+
+
 # ================== ДОСТИЖЕНИЯ ==================
 
 def try_unlock_achievement(user, chat_id, key):
@@ -318,7 +783,7 @@ def format_achievements(user):
 
 def get_daily_reward_and_update(user):
     """Считает награду за ежедневный бонус и обновляет стрик."""
-    now = time.time()
+    now = clock()
     last = user.get("last_daily", 0)
     streak = user.get("daily_streak", 0)
 
@@ -343,10 +808,522 @@ def get_daily_reward_and_update(user):
     return reward, streak
 
 
+# ================== ЗАПИСЬ АПДЕЙТОВ ==================
+
+def enable_update_recording(path):
+    """Пишет каждый полученный апдейт (сырой JSON + время прихода) в ротируемый лог."""
+    update_log = logging.getLogger("abu_bandit.updates")
+    update_log.setLevel(logging.INFO)
+    update_log.propagate = False
+    handler = RotatingFileHandler(
+        path, maxBytes=UPDATE_LOG_MAX_BYTES, backupCount=UPDATE_LOG_BACKUPS, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    update_log.addHandler(handler)
+
+    get_updates = apihelper.get_updates
+
+    def get_updates_and_record(*args, **kwargs):
+        updates = get_updates(*args, **kwargs)
+        arrived = time.time()
+        for update in updates:
+            update_log.info(json.dumps({"ts": arrived, "update": update}, ensure_ascii=False))
+        return updates
+
+    apihelper.get_updates = get_updates_and_record
+
+
+# ================== ЭКСПОРТ ДЛЯ АНАЛИТИКИ ==================
+
+EXPORT_FORMATS = ("ndjson", "csv")
+EXPORT_FIELDS = [
+    "uid", "name", "coins", "earn_upgrade", "earn_per_click", "current_char",
+    *[f"level_{name}" for name in CHARACTERS],
+    "power_best_char", "power_best_level", "power_total_levels",
+    "daily_streak", "last_daily", "latyao_until", "achievements",
+    "created_at", "last_seen",
+]
+
+
+def player_record(uid, user):
+    """Плоская запись игрока: уровни разложены по колонкам, сила и заработок посчитаны."""
+    levels = user.get("levels", [0] * len(CHARACTERS))
+    best_char, best_level, total_levels, _ = calculate_power(user)
+    record = {
+        "uid": uid,
+        "name": user.get("name", ""),
+        "coins": user.get("coins", 0),
+        "earn_upgrade": user.get("earn_upgrade", 0),
+        "earn_per_click": get_effective_earn_per_click(user),
+        "current_char": CHARACTERS[user.get("current_char", 0)],
+        "power_best_char": CHARACTERS[best_char],
+        "power_best_level": best_level,
+        "power_total_levels": total_levels,
+        "daily_streak": user.get("daily_streak", 0),
+        "last_daily": user.get("last_daily", 0),
+        "latyao_until": user.get("latyao_until", 0),
+        "achievements": ";".join(user.get("achievements", [])),
+        "created_at": user.get("created_at", 0),
+        "last_seen": user.get("last_seen", user.get("created_at", 0)),
+    }
+    for i, name in enumerate(CHARACTERS):
+        record[f"level_{name}"] = levels[i] if i < len(levels) else 0
+    return record
+
+
+def iter_player_records(active_since=None, min_coins=None):
+    """Генератор записей для экспорта с необязательными фильтрами."""
+    for uid, user in user_data.iter_snapshot():
+        if min_coins is not None and user.get("coins", 0) < min_coins:
+            continue
+        if active_since is not None:
+            last_seen = user.get("last_seen", user.get("created_at", 0))
+            if last_seen < active_since:
+                continue
+        yield player_record(uid, user)
+
+
+def write_export(out, fmt, records):
+    """Пишет записи в текстовый поток, возвращает их количество."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            count += 1
+    else:
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def parse_export_args(args):
+    """Разбирает аргументы вида: csv days=7 min_coins=1000."""
+    fmt, active_since, min_coins = "ndjson", None, None
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if not value and key in EXPORT_FORMATS:
+            fmt = key
+        elif key == "days":
+            active_since = clock() - float(value) * 24 * 60 * 60
+        elif key == "min_coins":
+            min_coins = int(value)
+        else:
+            raise ValueError(arg)
+    return fmt, active_since, min_coins
+
+
+def run_export_cli(args):
+    """python bot.py export ... — офлайн-выгрузка: нужна только база, без токена и сети."""
+    try:
+        fmt, active_since, min_coins = parse_export_args(args)
+    except ValueError:
+        sys.exit("Использование: python bot.py export [ndjson|csv] [days=N] [min_coins=N]")
+    open_player_store()
+    # csv сам пишет \r\n, и текстовый stdout на Windows превратил бы их в \r\r\n;
+    # кодировку фиксируем, как у файла из /export, а не по кодовой странице консоли
+    sys.stdout.reconfigure(encoding="utf-8", newline="")
+    try:
+        write_export(sys.stdout, fmt, iter_player_records(active_since, min_coins))
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # читатель ушёл раньше (export | head): молча выходим, а остаток буфера
+        # сбрасываем в devnull, чтобы Python не ругался на трубу при завершении
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+# ================== АНТИФЛУД ==================
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        """Сколько секунд ждать до следующего токена."""
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else 1.0
+
+
+def classify_update(obj):
+    """Вид запроса для антифлуда: click / callback / heavy / other."""
+    if isinstance(obj, types.CallbackQuery):
+        return "callback"
+    text = (getattr(obj, "text", None) or "").strip()
+    if text.startswith("/"):
+        text = text.split()[0].split("@")[0]
+    if text in CLICK_COMMANDS:
+        return "click"
+    if text in HEAVY_COMMANDS:
+        return "heavy"
+    return "other"
+
+
+class FloodControl(BaseMiddleware):
+    """Отсекает спам до обработчиков: у каждого игрока своя корзина токенов на вид запроса.
+
+    Политики при пустой корзине:
+      drop  — молча выбрасываем;
+      merge — клики копим и засчитываем одним кликом «x N», когда появится токен;
+      warn  — один раз предупреждаем, дальше молча выбрасываем.
+
+    Время берётся из self.clock, а склеенные клики засчитываются по таймеру.
+    Реплей подставляет виртуальные часы, выключает таймеры (use_timers = False)
+    и сам вызывает run_due() — так антифлуд воспроизводится детерминированно.
+    """
+
+    update_types = ["message", "callback_query"]
+
+    def __init__(self, limits, clock=time.monotonic):
+        super().__init__()
+        self.limits = limits
+        self.clock = clock
+        self.use_timers = True
+        self._lock = threading.Lock()
+        self._buckets = {}      # (вид, uid) -> TokenBucket
+        self._warned = set()    # (вид, uid), кого уже предупредили
+        self._merged = {}       # uid -> [сколько кликов накопилось, последнее сообщение]
+        self._due = []          # куча (когда, uid) склеенных кликов, если таймеры выключены
+        self.counters = {
+            kind: {"passed": 0, "dropped": 0, "merged": 0, "warned": 0} for kind in limits
+        }
+
+    def _bucket(self, kind, uid, now):
+        key = (kind, uid)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= FLOOD_MAX_BUCKETS:
+                self._prune(now)
+            rate, burst, _ = self.limits[kind]
+            bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _prune(self, now):
+        # полные корзины ничего не помнят — их можно пересоздать с нуля
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+                self._warned.discard(key)
+
+    def allow(self, obj):
+        if not FLOOD_CONTROL_ENABLED:
+            return True
+        kind = classify_update(obj)
+        uid = get_user_id(obj)
+        policy = self.limits[kind][2]
+        now = self.clock()
+        with self._lock:
+            bucket = self._bucket(kind, uid, now)
+            if bucket.take(now):
+                self.counters[kind]["passed"] += 1
+                self._warned.discard((kind, uid))
+                return True
+
+            if policy == "merge" and kind == "click":
+                self.counters[kind]["merged"] += 1
+                pending = self._merged.get(uid)
+                if pending is not None:
+                    pending[0] += 1
+                    pending[1] = obj
+                    return False
+                self._merged[uid] = [1, obj]
+                delay = bucket.wait_time()
+                if not self.use_timers:
+                    heapq.heappush(self._due, (now + delay, uid))
+                    return False
+                action = "merge"
+            elif policy == "warn" and (kind, uid) not in self._warned:
+                self.counters[kind]["warned"] += 1
+                self._warned.add((kind, uid))
+                action = "warn"
+            else:
+                self.counters[kind]["dropped"] += 1
+                action = "drop"
+
+        # в Telegram ходим уже без блокировки
+        if action == "merge":
+            timer = threading.Timer(delay, self._flush_merged, args=(uid,))
+            timer.daemon = True
+            timer.start()
+        elif action == "warn":
+            self._warn(obj)
+        elif kind == "callback":
+            # выброшенное нажатие всё равно гасим, иначе спиннер на кнопке крутится,
+            # пока Telegram сам не сдастся
+            try:
+                bot.answer_callback_query(obj.id)
+            except Exception:
+                log.warning("Не удалось погасить нажатие %s", obj.id, exc_info=True)
+        return False
+
+    def _warn(self, obj):
+        text = "⏳ Слишком часто! Подожди пару секунд."
+        if classify_update(obj) == "callback":
+            bot.answer_callback_query(obj.id, text)
+        else:
+            bot.send_message(obj.chat.id, text)
+
+    def _flush_merged(self, uid):
+        with self._lock:
+            pending = self._merged.get(uid)
+            if pending is None:
+                return  # уже засчитали вместе с обычным кликом
+            # склеенный клик тоже тратит токен, даже если уйдём в минус
+            now = self.clock()
+            bucket = self._bucket("click", uid, now)
+            bucket.refill(now)
+            bucket.tokens -= 1
+            message = pending[1]
+        try:
+            do_click(message, clicks=0)
+        finally:
+            user_data.release()  # таймер — не обработчик, ReleasePlayers тут не сработает
+
+    def run_due(self, now):
+        """Засчитывает склеенные клики, срок которых настал (только при use_timers = False)."""
+        while True:
+            with self._lock:
+                if not self._due or self._due[0][0] > now:
+                    return
+                _, uid = heapq.heappop(self._due)
+            self._flush_merged(uid)
+
+    def take_merged_clicks(self, uid):
+        """Забирает накопленные антифлудом клики игрока."""
+        with self._lock:
+            pending = self._merged.pop(uid, None)
+        return pending[0] if pending else 0
+
+    def pre_process(self, obj, data):
+        if not self.allow(obj):
+            return CancelUpdate()
+
+    def post_process(self, obj, data, exception):
+        pass
+
+
+# ================== ОТЛОЖЕННЫЕ ПРАВКИ ==================
+
+class DeferredEditor:
+    """Правит сообщения в фоне, уже после answer_callback_query.
+
+    Правки одного сообщения, пришедшие за EDIT_DEBOUNCE секунд, склеиваются —
+    уходит только последняя. Пока правка отправляется, новые ждут её окончания
+    и уходят следом, поэтому старая версия не может приехать после новой.
+    Если текст и клавиатура совпадают с последней отправленной версией, правка
+    не отправляется вовсе (Telegram всё равно ответил бы «message is not modified»).
+    """
+
+    def __init__(self, debounce, hash_cache_size):
+        self.debounce = debounce
+        self.hash_cache_size = hash_cache_size
+        self._lock = threading.Lock()
+        self._pending = {}              # (chat_id, message_id) -> (text, reply_markup)
+        self._busy = set()              # сообщения, для которых уже ждёт таймер или идёт отправка
+        self._last_hash = OrderedDict()  # (chat_id, message_id) -> хэш последней отправленной версии
+        self.counters = {"scheduled": 0, "collapsed": 0, "unchanged": 0, "sent": 0, "failed": 0}
+
+    def remember(self, chat_id, message_id, text=None, reply_markup=None):
+        """Запомнить версию, отправленную мимо редактора (send_message), чтобы не повторять её правкой."""
+        with self._lock:
+            self._remember_hash((chat_id, message_id), self._content_hash(text, reply_markup))
+
+    def schedule(self, chat_id, message_id, text=None, reply_markup=None):
+        """Запланировать правку. text=None — меняем только клавиатуру (None — убрать её)."""
+        key = (chat_id, message_id)
+        with self._lock:
+            self.counters["scheduled"] += 1
+            if key in self._pending:
+                self.counters["collapsed"] += 1
+            self._pending[key] = (text, reply_markup)
+            if key in self._busy:
+                return  # подхватит уже запущенный _apply
+            self._busy.add(key)
+        if self.debounce <= 0:
+            self._apply(key)
+            return
+        timer = threading.Timer(self.debounce, self._apply, args=(key,))
+        timer.daemon = True
+        timer.start()
+
+    @staticmethod
+    def _content_hash(text, reply_markup):
+        markup = reply_markup.to_json() if reply_markup is not None else ""
+        return hashlib.sha1(f"{text}\0{markup}".encode("utf-8")).hexdigest()
+
+    def _remember_hash(self, key, digest):
+        self._last_hash[key] = digest
+        self._last_hash.move_to_end(key)
+        while len(self._last_hash) > self.hash_cache_size:
+            self._last_hash.popitem(last=False)
+
+    def _apply(self, key):
+        # отправляем самую свежую правку; если за время отправки пришла новая — и её следом
+        while True:
+            with self._lock:
+                item = self._pending.pop(key, None)
+                if item is None:
+                    self._busy.discard(key)
+                    return
+                text, reply_markup = item
+                digest = self._content_hash(text, reply_markup)
+                if self._last_hash.get(key) == digest:
+                    self.counters["unchanged"] += 1
+                    continue
+            if self._send(key, text, reply_markup):
+                with self._lock:
+                    self.counters["sent"] += 1
+                    self._remember_hash(key, digest)
+
+    def _send(self, key, text, reply_markup):
+        chat_id, message_id = key
+        try:
+            if text is None:
+                bot.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
+            else:
+                bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=text,
+                    reply_markup=reply_markup,
+                    parse_mode="HTML"
+                )
+        except apihelper.ApiTelegramException as e:
+            if "message is not modified" in str(e.description):
+                return True
+            log.warning("Не удалось изменить сообщение %s: %s", key, e)
+        except Exception:
+            log.exception("Не удалось изменить сообщение %s", key)
+        else:
+            return True
+        with self._lock:
+            self.counters["failed"] += 1
+        return False
+
+
+# ================== СВЯЗЬ С TELEGRAM ==================
+
+class BotApiTransport:
+    """Отправка запросов к Bot API вместо стандартной сессии telebot.
+
+    Одна общая requests.Session с пулом keep-alive соединений на все потоки —
+    TLS-рукопожатие делается один раз, а не на каждый поток. Временные ошибки
+    (обрыв соединения, 429, 5xx) повторяются с экспоненциальной задержкой и
+    случайным разбросом. Неидемпотентные методы (sendMessage и т.п.) повторяем,
+    только если запрос точно не дошёл до Telegram.
+    """
+
+    def __init__(self, pool_size, max_retries, backoff_base, backoff_max):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=2, pool_maxsize=pool_size, max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._jitter = random.Random()  # свой генератор, чтобы не сбивать random игры
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "failures": 0, "throttled": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _backoff(self, attempt):
+        return self._jitter.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        api_method = url.rsplit("/", 1)[-1]
+        idempotent = api_method in HTTP_IDEMPOTENT_METHODS and not files
+        attempt = 0
+        while True:
+            self._count("requests")
+            error = None
+            try:
+                response = self.session.request(
+                    method, url, params=params, files=files, timeout=timeout, proxies=proxies
+                )
+            except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
+                # не смогли даже подключиться — запрос точно не дошёл, его можно повторить;
+                # иначе ответа нет, но запрос мог дойти — повторяем только безопасные методы
+                not_sent = isinstance(e, requests.exceptions.ConnectTimeout) or isinstance(
+                    getattr(e.args[0], "reason", None) if e.args else None, NewConnectionError
+                )
+                retry = not files if not_sent else idempotent
+                delay, response, error = self._backoff(attempt), None, e
+            else:
+                if response.status_code == 429:
+                    self._count("throttled")
+                    try:
+                        retry_after = response.json()["parameters"]["retry_after"]
+                    except Exception:
+                        retry_after = self._backoff(attempt)
+                    retry, delay = not files and retry_after <= self.backoff_max, retry_after
+                elif response.status_code >= 500:
+                    retry, delay = idempotent, self._backoff(attempt)
+                else:
+                    return response
+
+            if not retry or attempt >= self.max_retries:
+                self._count("failures")
+                if error is not None:
+                    raise error
+                return response  # telebot сам превратит ответ в ApiTelegramException
+            self._count("retries")
+            log.info("Повтор %s (попытка %d) через %.2f с", api_method, attempt + 1, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def setup_transport():
+    if TELEGRAM_API_URL:
+        apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+    apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+    transport = BotApiTransport(HTTP_POOL_SIZE, HTTP_MAX_RETRIES, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX)
+    apihelper.CUSTOM_REQUEST_SENDER = transport
+    return transport
+
+
 # ================== ИНИЦИАЛИЗАЦИЯ БОТА ==================
 
+# python bot.py export [ndjson|csv] [days=N] [min_coins=N] > players.ndjson
+if __name__ == "__main__" and sys.argv[1:2] == ["export"]:
+    run_export_cli(sys.argv[2:])
+    sys.exit(0)
+
 load_data()
-bot = telebot.TeleBot(TOKEN, parse_mode="HTML")  # HTML для нормального интерфейса
+transport = setup_transport()
+bot = telebot.TeleBot(
+    TOKEN,
+    parse_mode="HTML",  # HTML для нормального интерфейса
+    num_threads=BOT_NUM_THREADS,
+    use_class_middlewares=True,
+)
+flood_control = FloodControl(FLOOD_LIMITS)
+bot.setup_middleware(flood_control)
+bot.setup_middleware(ReleasePlayers())
+message_editor = DeferredEditor(EDIT_DEBOUNCE, EDIT_HASH_CACHE_SIZE)
 
 
 # ================== ОБРАБОТЧИКИ КОМАНД ==================
@@ -409,15 +1386,17 @@ def btn_click(message):
     do_click(message)
 
 
-def do_click(message):
+def do_click(message, clicks=1):
+    # клики, склеенные антифлудом, засчитываем одним заходом
+    clicks += flood_control.take_merged_clicks(get_user_id(message))
+    if clicks <= 0:
+        return
+
     user = ensure_user(message)
     base_earn = get_effective_earn_per_click(user)
 
-    crit = random.random() < CRIT_CHANCE
-    if crit:
-        earn = base_earn * CRIT_MULTIPLIER
-    else:
-        earn = base_earn
+    crits = sum(1 for _ in range(clicks) if random.random() < CRIT_CHANCE)
+    earn = base_earn * (clicks + crits * (CRIT_MULTIPLIER - 1))
 
     user["coins"] += earn
     save_data()
@@ -425,12 +1404,15 @@ def do_click(message):
     extra = ""
     if is_latyao_active(user):
         extra += " (с учётом Латяо 🔥)"
-    if crit:
+    if crits == 1:
         extra += " <b>КРИТ!</b> 💥"
+    elif crits > 1:
+        extra += f" <b>КРИТ x{crits}!</b> 💥"
 
+    clicked = "Ты кликнул" if clicks == 1 else f"Ты кликнул <b>{clicks}</b> раз"
     bot.send_message(
         message.chat.id,
-        f"Ты кликнул и заработал <b>{earn}</b> жиркоинов{extra}!\n"
+        f"{clicked} и заработал <b>{earn}</b> жиркоинов{extra}!\n"
         f"Текущий баланс: <b>{user['coins']}</b> жиркоинов."
     )
 
@@ -461,12 +1443,7 @@ def show_upgrade_menu(chat_id, user, call_message_id=None, edit=False):
             "(без учёта Латяо)."
         )
         if edit and call_message_id is not None:
-            bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=call_message_id,
-                text=text,
-                parse_mode="HTML"
-            )
+            message_editor.schedule(chat_id, call_message_id, text)
         else:
             bot.send_message(chat_id, text)
         return
@@ -485,36 +1462,22 @@ def show_upgrade_menu(chat_id, user, call_message_id=None, edit=False):
     kb.add(types.InlineKeyboardButton("Закрыть меню ❌", callback_data="upgrade_close"))
 
     if edit and call_message_id is not None:
-        bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=call_message_id,
-            text=text,
-            reply_markup=kb,
-            parse_mode="HTML"
-        )
+        message_editor.schedule(chat_id, call_message_id, text, kb)
     else:
-        bot.send_message(chat_id, text, reply_markup=kb)
+        sent = bot.send_message(chat_id, text, reply_markup=kb)
+        message_editor.remember(chat_id, sent.message_id, text, kb)
 
 
 @bot.callback_query_handler(func=lambda call: call.data in ["upgrade_buy", "upgrade_close"])
 def callback_upgrade(call):
-    uid = get_user_id(call)
-    if uid not in user_data:
+    user = user_data.get(get_user_id(call))
+    if user is None:
         bot.answer_callback_query(call.id, "Игрок не найден. Напиши /start.")
         return
 
-    user = user_data[uid]
-
     if call.data == "upgrade_close":
         bot.answer_callback_query(call.id, "Меню закрыто.")
-        try:
-            bot.edit_message_reply_markup(
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=None
-            )
-        except Exception:
-            pass
+        message_editor.schedule(call.message.chat.id, call.message.message_id)
         return
 
     cost = get_next_upgrade_cost(user)
@@ -533,9 +1496,9 @@ def callback_upgrade(call):
 
     user["coins"] -= cost
     user["earn_upgrade"] += 1
-    save_data()
-
+    # сначала гасим спиннер на кнопке, запись на диск и правка меню — потом
     bot.answer_callback_query(call.id, "Улучшение куплено! ✅")
+    save_data()
     show_upgrade_menu(call.message.chat.id, user, call.message.message_id, edit=True)
 
 
@@ -626,7 +1589,7 @@ def do_latyao(message):
         return
 
     user["coins"] -= LATYAO_COST
-    now = time.time()
+    now = clock()
     current_until = user.get("latyao_until", 0)
     if current_until > now:
         user["latyao_until"] = current_until + LATYAO_DURATION
@@ -635,7 +1598,7 @@ def do_latyao(message):
 
     save_data()
 
-    left = int(user["latyao_until"] - time.time())
+    left = int(user["latyao_until"] - clock())
     minutes = left // 60
     seconds = left % 60
 
@@ -664,7 +1627,7 @@ def btn_daily(message):
 
 def do_daily(message):
     user = ensure_user(message)
-    now = time.time()
+    now = clock()
     last = user.get("last_daily", 0)
 
     if last != 0 and now - last < DAILY_COOLDOWN:
@@ -749,46 +1712,78 @@ def btn_leaderboard(message):
 
 
 def do_leaderboard(message):
-    if not user_data:
-        bot.send_message(message.chat.id, "Пока нет ни одного игрока.")
-        return
+    # в группах сначала показываем топ этого чата
+    scope = "c" if message.chat.type in ("group", "supergroup") else "g"
+    text, kb = render_leaderboard(scope, message.chat.id, get_user_id(message), page=0)
+    sent = bot.send_message(message.chat.id, text, reply_markup=kb)
+    message_editor.remember(message.chat.id, sent.message_id, text, kb)
 
-    sorted_players = sorted(
-        user_data.items(),
-        key=lambda item: calculate_power(item[1]),
-        reverse=True
-    )
 
-    lines = ["<b>🏆 Лидерборд:</b>"]
-    max_show = min(10, len(sorted_players))
-
-    for idx in range(max_show):
-        uid, u = sorted_players[idx]
-        levels = u.get("levels", [0] * len(CHARACTERS))
-        best_char = 0
-        for i, lvl in enumerate(levels):
-            if lvl > 0:
-                best_char = i
-        best_lvl = levels[best_char]
+def render_leaderboard(scope, chat_id, uid_me, page):
+    """Страница лидерборда: scope "g" — общий, "c" — по чату. page=None — страница с игроком."""
+    rank_chat = str(chat_id) if scope == "c" else None
+    is_group = scope == "c" or int(chat_id) < 0
+    total = user_data.rank_count(rank_chat)
+    my_rank = user_data.rank_of(uid_me, rank_chat)
+
+    if page is None:
+        page = (my_rank or 0) // LEADERBOARD_PAGE_SIZE
+    pages = max(1, (total + LEADERBOARD_PAGE_SIZE - 1) // LEADERBOARD_PAGE_SIZE)
+    page = max(0, min(page, pages - 1))
+
+    kb = types.InlineKeyboardMarkup()
+    if is_group:
+        if scope == "c":
+            kb.add(types.InlineKeyboardButton("🌍 Общий лидерборд", callback_data="lb_g_0"))
+        else:
+            kb.add(types.InlineKeyboardButton("💬 Лидерборд чата", callback_data="lb_c_0"))
+
+    if total == 0:
+        if scope == "c":
+            return "В этом чате пока нет игроков. Нажми «Кликнуть 💰» и будь первым!", kb
+        return "Пока нет ни одного игрока.", kb
+
+    title = "🏆 Лидерборд чата" if scope == "c" else "🏆 Лидерборд"
+    lines = [f"<b>{title}</b> (страница {page + 1}/{pages}):"]
+
+    start = page * LEADERBOARD_PAGE_SIZE
+    for pos, uid in enumerate(user_data.rank_page(start, LEADERBOARD_PAGE_SIZE, rank_chat), start=start + 1):
+        u = user_data.peek(uid) or {}
+        best_char, best_lvl, total_levels, coins = calculate_power(u)
         name = u.get("name", f"Игрок_{uid}")
+        mark = "👉 " if uid == uid_me else ""
         lines.append(
-            f"{idx+1}. <b>{name}</b> — {CHARACTERS[best_char]} "
-            f"(уровень {best_lvl}), всего уровней: {sum(levels)}, монет: {u.get('coins', 0)}"
+            f"{mark}{pos}. <b>{name}</b> — {CHARACTERS[best_char]} "
+            f"(уровень {best_lvl}), всего уровней: {total_levels}, монет: {coins}"
         )
 
-    uid_me = get_user_id(message)
-    my_pos = None
-    for idx, (uid, _) in enumerate(sorted_players):
-        if uid == uid_me:
-            my_pos = idx + 1
-            break
-
-    if my_pos is not None:
-        lines.append(f"\nТвоя позиция: <b>{my_pos}</b> из {len(sorted_players)}.")
+    if my_rank is not None:
+        lines.append(f"\nТвоя позиция: <b>{my_rank + 1}</b> из {total}.")
     else:
         lines.append("\nТы ещё не в лидерборде. Нажми «Кликнуть 💰» и начинай путь!")
 
-    bot.send_message(message.chat.id, "\n".join(lines))
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton("⬅", callback_data=f"lb_{scope}_{page - 1}"))
+    nav.append(types.InlineKeyboardButton("📍 Я", callback_data=f"lb_{scope}_me"))
+    if page < pages - 1:
+        nav.append(types.InlineKeyboardButton("➡", callback_data=f"lb_{scope}_{page + 1}"))
+    kb.row(*nav)
+    return "\n".join(lines), kb
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("lb_"))
+def callback_leaderboard(call):
+    try:
+        _, scope, page = call.data.split("_")
+        page = None if page == "me" else int(page)
+    except ValueError:
+        bot.answer_callback_query(call.id, "Ошибка лидерборда.")
+        return
+
+    bot.answer_callback_query(call.id)
+    text, kb = render_leaderboard(scope, call.message.chat.id, get_user_id(call), page)
+    message_editor.schedule(call.message.chat.id, call.message.message_id, text, kb)
 
 
 # ----- ВЫБОР ПЕРСОНАЖА -----
@@ -827,12 +1822,10 @@ def do_choose(message):
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("choose_char_"))
 def callback_choose_char(call):
-    uid = get_user_id(call)
-    if uid not in user_data:
+    user = user_data.get(get_user_id(call))
+    if user is None:
         bot.answer_callback_query(call.id, "Игрок не найден. Напиши /start.")
         return
-
-    user = user_data[uid]
     max_available = get_max_available_character_index(user)
     levels = user["levels"]
 
@@ -847,16 +1840,9 @@ def callback_choose_char(call):
         return
 
     user["current_char"] = idx
-    save_data()
     bot.answer_callback_query(call.id, f"Теперь ты играешь за {CHARACTERS[idx]}!")
-    try:
-        bot.edit_message_reply_markup(
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=None
-        )
-    except Exception:
-        pass
+    save_data()
+    message_editor.schedule(call.message.chat.id, call.message.message_id)
 
     bot.send_message(
         call.message.chat.id,
@@ -866,6 +1852,65 @@ def callback_choose_char(call):
     )
 
 
+# ----- СЛУЖЕБНОЕ (только для админов) -----
+
+def format_metrics():
+    cache = user_data.metrics()
+    lines = [
+        "<b>🛠 Метрики</b>",
+        "",
+        "<b>🧊 Кэш игроков:</b>",
+        f"• в памяти: {cache['size']} / {cache['capacity']}",
+        f"• всего игроков: {len(user_data)}",
+        f"• попадания: {cache['hits']}, промахи: {cache['misses']} "
+        f"(hit rate {cache['hit_rate']:.1%})",
+        f"• вытеснено: {cache['evictions']}, записей на диск: {cache['writes']}",
+        "",
+        "<b>🚦 Антифлуд</b> (пропущено / склеено / предупреждено / выброшено):",
+    ]
+    for kind, c in flood_control.counters.items():
+        lines.append(f"• {kind}: {c['passed']} / {c['merged']} / {c['warned']} / {c['dropped']}")
+    t = transport.counters
+    lines += [
+        "",
+        "<b>🌐 Bot API:</b>",
+        f"• запросов: {t['requests']}, повторов: {t['retries']}, "
+        f"429: {t['throttled']}, неудач: {t['failures']}",
+    ]
+    e = message_editor.counters
+    lines += [
+        "",
+        "<b>✏️ Правки сообщений:</b>",
+        f"• запланировано: {e['scheduled']}, склеено: {e['collapsed']}, без изменений: {e['unchanged']}",
+        f"• отправлено: {e['sent']}, ошибок: {e['failed']}",
+    ]
+    return "\n".join(lines)
+
+
+@bot.message_handler(commands=["metrics"], func=is_admin)
+def cmd_metrics(message):
+    bot.send_message(message.chat.id, format_metrics())
+
+
+@bot.message_handler(commands=["export"], func=is_admin)
+def cmd_export(message):
+    try:
+        fmt, active_since, min_coins = parse_export_args(message.text.split()[1:])
+    except ValueError:
+        bot.send_message(
+            message.chat.id,
+            "Использование: /export [ndjson|csv] [days=N] [min_coins=N]"
+        )
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"players.{fmt}")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            count = write_export(f, fmt, iter_player_records(active_since, min_coins))
+        with open(path, "rb") as f:
+            bot.send_document(message.chat.id, f, caption=f"📤 Игроков в выгрузке: {count}")
+
+
 # ----- ОБРАБОТКА ПРОЧЕГО ТЕКСТА -----
 
 @bot.message_handler(content_types=["text"])
@@ -881,9 +1926,155 @@ def fallback(message):
 
 # ================== ЗАПУСК ==================
 
+def drain_startup_backlog():
+    """Быстро разбирает апдейты, накопившиеся за время простоя, до обычного поллинга.
+
+    Начинаем с сохранённого offset, просим только ALLOWED_UPDATES. Свежие апдейты
+    идут в обработчики как обычно, а к устаревшим применяется политика STARTUP_STALE_*:
+    клики одного игрока склеиваются в один зачёт, прочие сообщения выбрасываются,
+    протухшие нажатия кнопок молча гасятся.
+
+    Если Telegram недоступен, не падаем: что успели разобрать — засчитываем,
+    остальное достанется infinity_polling, который сам повторяет запросы.
+    """
+    offset = user_data.get_meta("last_update_id", 0)
+    stats = Counter()
+    merged_clicks = {}  # uid -> [сколько кликов, последнее сообщение]
+
+    # у нажатий нет своей даты, поэтому их возраст оцениваем по простою бота: поллинг
+    # раз в OFFSET_SAVE_INTERVAL отмечает «жив» (плюс до 20 секунд long polling).
+    # После короткого рестарта все нажатия в очереди свежие.
+    alive_at = user_data.get_meta("alive_at")
+    downtime = time.time() - alive_at if alive_at else None
+    callbacks_may_be_stale = downtime is None or downtime > STARTUP_STALE_AFTER
+
+    while True:
+        try:
+            # long_polling_timeout=0 telebot заменяет на 20 секунд, поэтому ждём минимум — 1 секунду
+            updates = bot.get_updates(
+                offset=offset + 1, limit=STARTUP_BATCH_SIZE, timeout=10,
+                allowed_updates=ALLOWED_UPDATES, long_polling_timeout=1,
+            )
+        except Exception:
+            log.exception("Не удалось разобрать очередь после рестарта, остаток разберёт обычный поллинг")
+            break
+
+        fresh = []
+        cutoff = time.time() - STARTUP_STALE_AFTER  # даты апдейтов — настоящее время Telegram
+        for update in updates:
+            offset = max(offset, update.update_id)
+            message, call = update.message, update.callback_query
+            if message is not None and message.date < cutoff:
+                # у кликов своя политика (merge/drop), STARTUP_STALE_MESSAGES — только для прочих
+                if classify_update(message) == "click":
+                    policy = "merge" if STARTUP_STALE_CLICKS == "merge" else "drop"
+                else:
+                    policy = "process" if STARTUP_STALE_MESSAGES == "process" else "drop"
+                if policy == "merge":
+                    pending = merged_clicks.setdefault(get_user_id(message), [0, message])
+                    pending[0] += 1
+                    pending[1] = message
+                    stats["merged"] += 1
+                elif policy == "process":
+                    fresh.append(update)
+                else:
+                    stats["dropped"] += 1
+            elif (
+                call is not None and STARTUP_STALE_CALLBACKS != "process" and callbacks_may_be_stale
+                # сообщение с кнопкой отправлено недавно — значит, и нажатие свежее
+                and getattr(call.message, "date", 0) < cutoff
+            ):
+                if STARTUP_STALE_CALLBACKS == "answer":
+                    try:
+                        bot.answer_callback_query(call.id)
+                    except apihelper.ApiTelegramException:
+                        pass  # «query is too old» — Telegram уже сам погасил спиннер
+                    except Exception:
+                        log.warning("Не удалось погасить нажатие %s", call.id, exc_info=True)
+                stats["callbacks"] += 1
+            else:
+                fresh.append(update)
+
+        stats["processed"] += len(fresh)
+        if fresh:
+            bot.process_new_updates(fresh)
+        if not merged_clicks:
+            # пока есть незачтённые склеенные клики, offset не двигаем: упадём — Telegram
+            # отдаст их заново (а свежие апдейты после них обработаются повторно)
+            user_data.set_meta("last_update_id", offset)
+        if len(updates) < STARTUP_BATCH_SIZE:
+            break  # очередь разобрана, дальше — обычный поллинг
+
+    for count, message in merged_clicks.values():
+        try:
+            do_click(message, clicks=count)
+        except Exception:
+            # монеты do_click сохраняет до ответа, так что теряется разве что сообщение игроку
+            log.exception("Не удалось засчитать %d склеенных кликов игрока %s", count, get_user_id(message))
+        finally:
+            user_data.release()
+    user_data.set_meta("last_update_id", offset)
+
+    bot.last_update_id = offset
+    log.info(
+        "Очередь после рестарта разобрана: обработано %d, склеено кликов %d (игроков %d), "
+        "выброшено %d, погашено нажатий %d, простой %s",
+        stats["processed"], stats["merged"], len(merged_clicks), stats["dropped"], stats["callbacks"],
+        f"{downtime:.0f} с" if downtime is not None else "неизвестен",
+    )
+
+
+def remember_polling_state():
+    """Сохраняет offset обработанных апдейтов и время, когда бот был жив.
+
+    Offset нужен, чтобы после рестарта не повторять апдейты, а отметка «жив» — чтобы
+    drain_startup_backlog знал, сколько бот простоял. Поллинг зовёт process_new_updates
+    после каждого getUpdates, даже пустого, поэтому отметка обновляется и без апдейтов.
+    """
+    process_new_updates = bot.process_new_updates
+    state = {"saved_at": 0.0}
+
+    def process_and_remember(updates):
+        process_new_updates(updates)
+        now = time.monotonic()
+        if now - state["saved_at"] >= OFFSET_SAVE_INTERVAL:
+            save_polling_state()
+            state["saved_at"] = now
+
+    bot.process_new_updates = process_and_remember
+
+
+def save_polling_state():
+    user_data.set_meta("last_update_id", bot.last_update_id)
+    user_data.set_meta("alive_at", time.time())
+
+
+def stop_on_sigterm(signum, frame):
+    """SIGTERM (docker stop, systemd) по умолчанию убивает процесс без finally.
+
+    Превращаем его в KeyboardInterrupt, как Ctrl+C: telebot штатно останавливает
+    поллинг, а мы успеваем сохранить offset и данные. Повторный SIGTERM игнорируем,
+    чтобы он не прервал само сохранение.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     print("Bot is running...")
-    bot.infinity_polling()
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+    drain_startup_backlog()
+    if UPDATE_LOG_FILE:
+        # пишем только после разбора очереди: склеенные и выброшенные при старте апдейты
+        # реплей проиграл бы как обычные
+        enable_update_recording(UPDATE_LOG_FILE)
+    remember_polling_state()
+    try:
+        bot.infinity_polling(allowed_updates=ALLOWED_UPDATES)
+    finally:
+        save_polling_state()
+        save_data()
 
 
 
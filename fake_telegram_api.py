@@ -0,0 +1,468 @@
+# Локальный фейковый Bot API для нагрузочного теста всего бота целиком
+#
+#   python fake_telegram_api.py --users 1000 --rate 300 --record sent.ndjson
+#   TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=1:fake python bot.py
+#
+# Умеет ровно то, чем пользуется bot.py: getUpdates, sendMessage, editMessageText,
+# editMessageReplyMarkup, answerCallbackQuery (плюс заглушки для служебных методов).
+# Генерирует апдейты от виртуальных игроков (случайно или по сценарию),
+# может отвечать 429 и добавлять задержку, записывает всё, что отправил бот,
+# и раз в несколько секунд печатает пропускную способность и задержки.
+#
+# Задержку ответа меряем только там, где ответ однозначно связан с апдейтом:
+#   - нажатия кнопок — по callback_query_id в answerCallbackQuery;
+#   - сообщения — по игрокам-пробам: каждый шлёт «Статистика 📊» и ждёт ответа,
+#     прежде чем отправить следующее, поэтому любой ответ в его чат — ответ на пробу.
+# Остальные игроки генерируют фоновую нагрузку; часть их апдейтов бот по замыслу
+# склеивает или выбрасывает (антифлуд, разбор очереди после рестарта), поэтому
+# для них считаем только количество ответов.
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+# что делают виртуальные игроки и с какой частотой (можно переопределить через --mix)
+DEFAULT_MIX = {
+    "click": 80,
+    "upgrade_menu": 4,
+    "upgrade_buy": 6,
+    "levelup": 3,
+    "latyao": 1,
+    "daily": 1,
+    "stats": 2,
+    "leaderboard": 2,
+    "choose": 1,
+}
+ACTION_TEXTS = {
+    "click": "Кликнуть 💰",
+    "upgrade_menu": "Улучшения ⚙",
+    "levelup": "Уровень ⬆",
+    "latyao": "Латяо 🔥",
+    "daily": "/daily",
+    "stats": "Статистика 📊",
+    "leaderboard": "/leaderboard",
+    "choose": "Выбор персонажа 👤",
+}
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Абу-бандит", "username": "abu_bandit_bot"}
+
+
+class FakeTelegram:
+    """Состояние фейкового Telegram: очередь апдейтов, отправленные сообщения, статистика."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)  # только для генератора апдейтов
+        # у HTTP-потоков свой генератор, иначе сбои сдвигают последовательность апдейтов
+        self.fault_rng = random.Random(f"faults-{args.seed}")
+        self.mix = args.mix
+        self.cond = threading.Condition()
+        self.pending = deque()       # апдейты, ещё не подтверждённые offset-ом
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.started_users = set()
+        self.upgrade_menus = {}      # chat_id -> message_id последнего меню улучшений
+        self.menu_chats = set()      # чаты, где генератор уже открывал меню улучшений
+        self.waiting_callbacks = {}  # callback_query_id -> время появления
+        self.callback_latencies = []
+        self.probe_users = range(args.users + 1, args.users + 1 + args.probes)
+        self.probe_waiting = {}      # chat_id пробы -> время отправки ещё не отвеченной пробы
+        self.probe_next = {uid: 0.0 for uid in self.probe_users}  # когда слать следующую
+        self.probe_latencies = []
+        self.probe_timeouts = 0
+        self.replies = Counter()     # ответы бота: probe / background
+        self.calls = Counter()
+        self.injected_429 = 0
+        self.emitted = 0
+        self.confirmed = 0
+        self.done = False
+        self.generating = True
+        self.record = open(args.record, "a", encoding="utf-8") if args.record else None
+        self.record_lock = threading.Lock()
+        self.script = self._load_script(args.script) if args.script else None
+
+    # ----- генерация апдейтов -----
+
+    @staticmethod
+    def _load_script(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"Игрок{uid}"}
+
+    def _chat(self, uid):
+        # часть игроков пишет из групп, чтобы нагружать и лидерборды чатов
+        if self.args.groups and uid not in self.probe_users and uid % 100 < self.args.group_share * 100:
+            gid = -(1000000 + uid % self.args.groups)
+            return {"id": gid, "type": "supergroup", "title": f"Группа {gid}"}
+        return {"id": uid, "type": "private", "first_name": f"Игрок{uid}"}
+
+    def _message_update(self, uid, text):
+        message = {
+            "message_id": self._new_message_id(),
+            "date": int(time.time()),
+            "chat": self._chat(uid),
+            "from": self._user(uid),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+
+    def _callback_update(self, uid, data, message_id):
+        return {
+            "callback_query": {
+                "id": f"cb{self.next_update_id}",
+                "from": self._user(uid),
+                "chat_instance": str(uid),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": self._chat(uid),
+                    "from": BOT_USER,
+                    "text": "меню",
+                },
+            }
+        }
+
+    def _new_message_id(self):
+        self.next_message_id += 1
+        return self.next_message_id
+
+    def _random_update(self):
+        uid = self.rng.randint(1, self.args.users)
+        if uid not in self.started_users:
+            self.started_users.add(uid)
+            return self._message_update(uid, "/start")
+        action = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        chat_id = self._chat(uid)["id"]
+        # решаем только по собственному состоянию генератора, а не по ответам бота,
+        # чтобы с одним --seed получалась одна и та же последовательность действий
+        if action == "upgrade_buy":
+            if chat_id not in self.menu_chats:
+                action = "upgrade_menu"
+            else:
+                return self._callback_update(uid, "upgrade_buy", self.upgrade_menus.get(chat_id, 1))
+        if action == "upgrade_menu":
+            self.menu_chats.add(chat_id)
+        return self._message_update(uid, ACTION_TEXTS[action])
+
+    def _scripted_update(self, i):
+        step = self.script[i % len(self.script)]
+        if "update_id" in step or "message" in step or "callback_query" in step:
+            return {k: v for k, v in step.items() if k != "update_id"}
+        uid = step["user"]
+        if "data" in step:
+            menu_id = step.get("message_id") or self.upgrade_menus.get(self._chat(uid)["id"], 1)
+            return self._callback_update(uid, step["data"], menu_id)
+        return self._message_update(uid, step["text"])
+
+    def _enqueue(self, update):
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        if "callback_query" in update:
+            self.waiting_callbacks[update["callback_query"]["id"]] = time.perf_counter()
+        self.pending.append(update)
+        self.cond.notify_all()
+
+    def emit(self):
+        """Кладёт в очередь один новый апдейт (вызывать под self.cond)."""
+        if self.script is not None:
+            update = self._scripted_update(self.emitted)
+        else:
+            update = self._random_update()
+        self._enqueue(update)
+        self.emitted += 1
+
+    def generator(self):
+        """Поток-генератор: с заданной скоростью или «сколько успеет съесть бот»."""
+        total = self.args.total
+        interval = 0.01
+        budget = 0.0
+        deadline = time.time() + self.args.duration if self.args.duration else None
+        while not self.done:
+            if (total and self.emitted >= total) or (deadline and time.time() >= deadline):
+                break
+            with self.cond:
+                if self.args.rate > 0:
+                    budget += self.args.rate * interval
+                    while budget >= 1 and not (total and self.emitted >= total):
+                        self.emit()
+                        budget -= 1
+                else:
+                    # без ограничения скорости держим очередь полной
+                    while len(self.pending) < self.args.backlog and not (total and self.emitted >= total):
+                        self.emit()
+                    self.cond.wait(interval)
+                    continue
+            time.sleep(interval)
+        self.generating = False
+
+    def prober(self):
+        """Поток проб: у каждой пробы не больше одного сообщения без ответа."""
+        while not self.done and self.generating:
+            now = time.perf_counter()
+            with self.cond:
+                for uid in self.probe_users:
+                    started = self.probe_waiting.get(uid)
+                    if started is not None:
+                        if now - started > self.args.reply_timeout:
+                            # ответа так и не было; выжидаем ещё столько же, чтобы поздний
+                            # ответ не засчитался следующей пробе
+                            del self.probe_waiting[uid]
+                            self.probe_timeouts += 1
+                            self.probe_next[uid] = now + self.args.reply_timeout
+                        continue
+                    if now >= self.probe_next[uid]:
+                        self.probe_waiting[uid] = now
+                        self._enqueue(self._message_update(uid, "Статистика 📊"))
+            time.sleep(0.01)
+
+    # ----- Bot API -----
+
+    def get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        limit = min(int(params.get("limit", 100) or 100), 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.pending and self.pending[0]["update_id"] < offset:
+                self.pending.popleft()
+                self.confirmed += 1
+            self.cond.notify_all()
+            while not self.pending and time.time() < deadline and not self.done:
+                self.cond.wait(deadline - time.time())
+            return [u for u in list(self.pending)[:limit] if u["update_id"] >= offset]
+
+    def _replied(self, chat_id):
+        now = time.perf_counter()
+        with self.cond:
+            started = self.probe_waiting.pop(chat_id, None)
+            if started is None:
+                self.replies["background"] += 1
+                return
+            self.replies["probe"] += 1
+            self.probe_latencies.append(now - started)
+            self.probe_next[chat_id] = now + self.args.probe_interval
+
+    def _answered_callback(self, callback_id):
+        now = time.perf_counter()
+        with self.cond:
+            started = self.waiting_callbacks.pop(callback_id, None)
+            if started is not None:
+                self.callback_latencies.append(now - started)
+
+    def _sent_message(self, params):
+        chat_id = int(params["chat_id"])
+        message_id = int(params.get("message_id") or 0)
+        if not message_id:
+            with self.cond:
+                message_id = self._new_message_id()
+        if "upgrade_buy" in params.get("reply_markup", ""):
+            with self.cond:
+                self.upgrade_menus[chat_id] = message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    def call(self, api_method, params):
+        """Возвращает (HTTP-код, JSON-ответ)."""
+        with self.cond:
+            self.calls[api_method] += 1
+        if api_method == "getUpdates":
+            return 200, {"ok": True, "result": self.get_updates(params)}
+
+        if self.args.latency_ms:
+            time.sleep(self.fault_rng.uniform(*self.args.latency_ms) / 1000)
+        if self.args.error_429 and self.fault_rng.random() < self.args.error_429:
+            with self.cond:
+                self.injected_429 += 1
+            retry_after = self.args.retry_after
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }
+
+        if self.record:
+            line = json.dumps({"ts": time.time(), "method": api_method, "params": params}, ensure_ascii=False)
+            with self.record_lock:
+                self.record.write(line + "\n")
+
+        if api_method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if api_method in ("sendMessage", "sendDocument"):
+            result = self._sent_message(params)
+            self._replied(result["chat"]["id"])
+            return 200, {"ok": True, "result": result}
+        if api_method in ("editMessageText", "editMessageReplyMarkup"):
+            return 200, {"ok": True, "result": self._sent_message(params)}
+        if api_method == "answerCallbackQuery":
+            self._answered_callback(params.get("callback_query_id"))
+        return 200, {"ok": True, "result": True}
+
+    # ----- статистика -----
+
+    def report(self, elapsed):
+        with self.cond:
+            probes = sorted(self.probe_latencies)
+            callbacks = sorted(self.callback_latencies)
+            unanswered_callbacks = len(self.waiting_callbacks)
+            calls = dict(self.calls)
+            replies = dict(self.replies)
+            confirmed = self.confirmed
+
+        def pct(latencies):
+            if not latencies:
+                return "—"
+            return "/".join(
+                f"{latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000:.0f}"
+                for p in (0.5, 0.95, 0.99)
+            ) + " мс"
+
+        print(
+            f"[{elapsed:6.1f} с] апдейтов: {self.emitted} (забрано ботом {confirmed}, "
+            f"{confirmed / elapsed:.0f}/с)  фоновых ответов: {replies.get('background', 0)}  "
+            f"429: {self.injected_429}",
+            flush=True,
+        )
+        print(
+            f"          пробы p50/p95/p99: {pct(probes)} (ответов {len(probes)}, "
+            f"без ответа {self.probe_timeouts})  нажатия p50/p95/p99: {pct(callbacks)} "
+            f"(погашено {len(callbacks)}, ждут {unanswered_callbacks})",
+            flush=True,
+        )
+        print("          вызовы: " + ", ".join(f"{m}={n}" for m, n in sorted(calls.items())), flush=True)
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # бот отключился посреди запроса (например, его перезапустили) — это не ошибка сервера
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего api.telegram.org
+        # заголовки и тело уходят двумя записями; без TCP_NODELAY на keep-alive
+        # соединении вторая ждёт delayed ACK клиента (~40 мс на каждый запрос)
+        disable_nagle_algorithm = True
+
+        def _params(self):
+            url = urlparse(self.path)
+            params = dict(parse_qsl(url.query))
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            content_type = self.headers.get("Content-Type", "")
+            if body and content_type.startswith("application/json"):
+                params.update(json.loads(body))
+            elif body and content_type.startswith("application/x-www-form-urlencoded"):
+                params.update(parse_qsl(body.decode("utf-8")))
+            return url.path, params
+
+        def do_GET(self):
+            path, params = self._params()
+            api_method = path.rstrip("/").rsplit("/", 1)[-1]
+            code, payload = fake.call(api_method, params)
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_POST = do_GET
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        action, _, weight = part.partition("=")
+        if action not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"неизвестное действие: {action}")
+        mix[action] = float(weight)
+    return mix
+
+
+def parse_latency(value):
+    low, _, high = value.partition(",")
+    return float(low), float(high or low)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=1000, help="сколько виртуальных игроков")
+    parser.add_argument("--rate", type=float, default=100,
+                        help="апдейтов в секунду; 0 — сколько успеет забрать бот")
+    parser.add_argument("--backlog", type=int, default=1000, help="размер очереди при --rate 0")
+    parser.add_argument("--total", type=int, default=0, help="остановить генерацию после N апдейтов")
+    parser.add_argument("--duration", type=float, default=0, help="остановить генерацию через N секунд")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="веса действий, например click=90,upgrade_buy=10")
+    parser.add_argument("--script", help="NDJSON-сценарий: {\"user\": 1, \"text\": ...} или "
+                                         "{\"user\": 1, \"data\": \"upgrade_buy\"} или готовый апдейт")
+    parser.add_argument("--groups", type=int, default=0, help="сколько групповых чатов")
+    parser.add_argument("--group-share", type=float, default=0.2, help="доля игроков, пишущих из групп")
+    parser.add_argument("--error-429", type=float, default=0, help="вероятность ответить 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--latency-ms", type=parse_latency, help="задержка ответа, например 20,80")
+    parser.add_argument("--probes", type=int, default=20,
+                        help="игроков-проб, по которым меряется задержка ответа на сообщение")
+    parser.add_argument("--probe-interval", type=float, default=1,
+                        help="пауза пробы между ответом и следующим сообщением, сек")
+    parser.add_argument("--reply-timeout", type=float, default=30,
+                        help="через сколько секунд проба считается оставшейся без ответа")
+    parser.add_argument("--record", help="куда записывать всё, что отправил бот (NDJSON)")
+    parser.add_argument("--report-every", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args)
+    server = FakeServer((args.host, args.port), make_handler(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=fake.generator, daemon=True).start()
+    threading.Thread(target=fake.prober, daemon=True).start()
+    print(f"Фейковый Bot API: TELEGRAM_API_URL=http://{args.host}:{args.port}", flush=True)
+
+    started = time.perf_counter()
+    try:
+        while True:
+            time.sleep(args.report_every)
+            fake.report(time.perf_counter() - started)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.done = True
+        with fake.cond:
+            fake.cond.notify_all()
+        fake.report(time.perf_counter() - started)
+        server.shutdown()
+        if fake.record:
+            fake.record.close()
+
+
+if __name__ == "__main__":
+    main()
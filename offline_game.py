@@ -0,0 +1,29 @@
+# Загрузка bot.py для офлайн-скриптов (replay.py, simulate_economy.py)
+#
+# bot.py открывает базу игроков прямо при импорте, поэтому окружение нужно
+# подготовить до import bot: своя база во временной папке, никакой боевой.
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def offline_game(name, initial_state=None, **env):
+    """Импортирует bot.py с базой во временной папке и отдаёт модуль игры.
+
+    initial_state — стартовые игроки в формате game_data.json (по умолчанию никого),
+    env — дополнительные переменные окружения для bot.py. На выходе база закрывается
+    (иначе на Windows временную папку не удалить), а папка удаляется.
+    """
+    with tempfile.TemporaryDirectory(prefix=f"abu_{name}_") as workdir:
+        os.environ.setdefault("BOT_TOKEN", f"0:{name}")
+        os.environ["PLAYER_DB_FILE"] = os.path.join(workdir, f"{name}.db")
+        os.environ["DATA_FILE"] = initial_state or os.path.join(workdir, "none.json")
+        os.environ.update(env)
+
+        import bot as game
+        try:
+            yield game
+        finally:
+            game.user_data.close()
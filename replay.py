@@ -0,0 +1,164 @@
+# Реплей записанных апдейтов через настоящие обработчики bot.py
+#
+# Запись: запусти бота с UPDATE_LOG_FILE=updates.log
+# Реплей: python replay.py updates.log --speed 0 --seed 42 --state-out final.json
+#
+# Bot API подменяется заглушкой, random засевается, а time.time() игры и часы
+# антифлуда заменяются виртуальными, которые идут по временам из лога.
+# Итоговое состояние игроков можно сравнить с прошлым прогоном (--expect-state).
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+from offline_game import offline_game
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class FakeResponse:
+    def __init__(self, result):
+        self.status_code = 200
+        self._json = {"ok": True, "result": result}
+        self.text = json.dumps(self._json, ensure_ascii=False)
+
+    def json(self):
+        return self._json
+
+
+class FakeBotApi:
+    """Заглушка Bot API: отвечает как Telegram и считает вызовы по методам."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.calls = Counter()
+        self._message_id = 0
+
+    def _message(self, params):
+        self._message_id += 1
+        return {
+            "message_id": int(params.get("message_id") or self._message_id),
+            "date": int(self.clock.now),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        params = params or {}
+        self.calls[api_method] += 1
+        if api_method in ("sendMessage", "sendDocument", "editMessageText", "editMessageReplyMarkup"):
+            return FakeResponse(self._message(params))
+        if api_method == "getMe":
+            return FakeResponse({"id": 1, "is_bot": True, "first_name": "replay", "username": "replay_bot"})
+        if api_method == "getUpdates":
+            return FakeResponse([])
+        return FakeResponse(True)
+
+
+def read_log(path):
+    """Читает лог вместе с ротированными кусками (path.N ... path.1, path) по порядку."""
+    parts = []
+    n = 1
+    while os.path.exists(f"{path}.{n}"):
+        parts.append(f"{path}.{n}")
+        n += 1
+    parts.reverse()
+    parts.append(path)
+    for part in parts:
+        with open(part, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def state_digest(state):
+    canonical = json.dumps(state, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def replay(game, args):
+    from telebot import apihelper, types
+
+    clock = VirtualClock()
+    api = FakeBotApi(clock)
+    apihelper.CUSTOM_REQUEST_SENDER = api
+    game.clock = clock.time
+    game.bot.threaded = False  # строго по очереди, иначе порядок кликов и random поплывут
+    game.message_editor.debounce = 0  # правки сразу, без фоновых таймеров
+    game.flood_control.clock = clock.time
+    game.flood_control.use_timers = False  # склеенные клики засчитываем сами, по виртуальному времени
+    random.seed(args.seed)
+
+    entries = list(read_log(args.log))
+    if not entries:
+        print("Лог пустой.")
+        return
+
+    first_ts = entries[0]["ts"]
+    started = time.perf_counter()
+    for entry in entries:
+        if args.speed > 0:
+            delay = (entry["ts"] - first_ts) / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        clock.now = entry["ts"]
+        game.flood_control.run_due(clock.now)
+        game.bot.process_new_updates([types.Update.de_json(entry["update"])])
+    game.flood_control.run_due(float("inf"))  # то, что в проде засчитали бы таймеры после конца лога
+    game.save_data()
+    elapsed = time.perf_counter() - started
+
+    state = dict(game.user_data.iter_snapshot())
+    digest = state_digest(state)
+
+    print(f"Апдейтов: {len(entries)} за {elapsed:.2f} с ({len(entries) / elapsed:.0f} апд/с)")
+    print(f"Игроков в итоге: {len(state)}, sha256 состояния: {digest}")
+    print("Вызовы Bot API: " + ", ".join(f"{m}={n}" for m, n in sorted(api.calls.items())))
+
+    if args.state_out:
+        with open(args.state_out, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+    if args.expect_state:
+        with open(args.expect_state, "r", encoding="utf-8") as f:
+            expected = json.load(f)
+        if expected == state:
+            print("✅ Состояние совпадает с ожидаемым.")
+        else:
+            differ = sorted(uid for uid in set(expected) | set(state) if expected.get(uid) != state.get(uid))
+            print(f"❌ Состояние отличается у {len(differ)} игроков: {', '.join(differ[:20])}")
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Реплей апдейтов через обработчики bot.py")
+    parser.add_argument("log", help="файл, записанный через UPDATE_LOG_FILE")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="1 — как в проде, 2 — вдвое быстрее, 0 — без пауз (по умолчанию)")
+    parser.add_argument("--seed", type=int, default=0, help="зерно для random (криты)")
+    parser.add_argument("--initial-state", help="стартовое состояние в формате game_data.json")
+    parser.add_argument("--state-out", help="куда сохранить итоговое состояние игроков")
+    parser.add_argument("--expect-state", help="сравнить итог с сохранённым состоянием")
+    parser.add_argument("--no-flood-control", action="store_true",
+                        help="выключить антифлуд (по умолчанию работает, как в проде, по виртуальным часам)")
+    args = parser.parse_args()
+
+    flood_control = "0" if args.no_flood_control else "1"
+    with offline_game("replay", args.initial_state, FLOOD_CONTROL=flood_control) as game:
+        replay(game, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# pip install numpy
+#
+# Симулятор экономики: как меняется прогресс игроков при другой настройке констант.
+#
+#   python simulate_economy.py --players 10000 --days 100
+#   python simulate_economy.py --earn-upgrade-base-cost 500 --level-factor 1.3
+#
+# Цены, заработок и награды берутся из функций bot.py (get_level_cost,
+# get_next_upgrade_cost, get_base_earn_per_click, get_daily_reward_and_update,
+# ACHIEVEMENTS_DEFS), а вся когорта игроков считается массивами NumPy.
+
+import argparse
+import time
+
+import numpy as np
+
+from offline_game import offline_game
+
+
+def apply_overrides(game, args):
+    """Подменяет в bot.py константы, заданные в командной строке."""
+    overrides = {
+        "EARN_UPGRADE_BASE_COST": args.earn_upgrade_base_cost,
+        "LEVEL_COST_CHAR_FACTOR": args.level_factor,
+        "CRIT_CHANCE": args.crit_chance,
+        "CRIT_MULTIPLIER": args.crit_multiplier,
+        "DAILY_BASE_REWARD": args.daily_base_reward,
+        "DAILY_STREAK_BONUS": args.daily_streak_bonus,
+        "LATYAO_COST": args.latyao_cost,
+    }
+    for name, value in overrides.items():
+        if value is not None:
+            setattr(game, name, value)
+
+
+def build_tables(game):
+    """Таблицы цен и наград, посчитанные настоящими функциями игры."""
+    n_chars = len(game.CHARACTERS)
+    max_upgrade = game.MAX_EARN_UPGRADE
+
+    earn = np.array(
+        [game.get_base_earn_per_click({"earn_upgrade": lvl}) for lvl in range(max_upgrade + 1)],
+        dtype=np.float64,
+    )
+    upgrade_cost = np.array(
+        [game.get_next_upgrade_cost({"earn_upgrade": lvl}) or np.inf for lvl in range(max_upgrade + 1)],
+        dtype=np.float64,
+    )
+    level_cost = np.full((n_chars, game.MAX_LEVEL_PER_CHAR + 1), np.inf)
+    for c in range(n_chars):
+        for lvl in range(game.MAX_LEVEL_PER_CHAR):
+            level_cost[c, lvl] = game.get_level_cost(c, lvl + 1)
+
+    # награда за ежедневный бонус по длине стрика (индекс = стрик, 0 не бывает)
+    daily = np.zeros(game.DAILY_MAX_STREAK_FOR_BONUS + 2)
+    real_clock = game.clock
+    try:
+        game.clock = lambda: 1.0 + game.DAILY_COOLDOWN
+        for streak in range(1, len(daily)):
+            user = {"last_daily": 0 if streak == 1 else 1.0, "daily_streak": streak - 1}
+            daily[streak], _ = game.get_daily_reward_and_update(user)
+    finally:
+        game.clock = real_clock
+
+    rewards = {key: d["reward"] for key, d in game.ACHIEVEMENTS_DEFS.items()}
+    return earn, upgrade_cost, level_cost, daily, rewards
+
+
+def simulate(game, args):
+    rng = np.random.default_rng(args.seed)
+    earn, upgrade_cost, level_cost, daily, rewards = build_tables(game)
+
+    P, D, S = args.players, args.days, args.sessions_per_day
+    n_chars = len(game.CHARACTERS)
+    max_level = game.MAX_LEVEL_PER_CHAR
+    crit_chance, crit_mult = game.CRIT_CHANCE, game.CRIT_MULTIPLIER
+    latyao_cost, latyao_duration = game.LATYAO_COST, game.LATYAO_DURATION
+    everyone = np.arange(P)
+
+    # характер игроков: сколько кликают в день (логнормально) и насколько регулярны
+    clicks_per_day = rng.lognormal(np.log(args.clicks_mean), args.clicks_sigma, P)
+    active_prob = np.clip(rng.normal(args.active_prob, 0.15, P), 0.05, 1.0)
+
+    coins = np.zeros(P)
+    earn_lvl = np.zeros(P, dtype=np.int64)
+    levels = np.zeros((P, n_chars), dtype=np.int64)
+    streak = np.zeros(P, dtype=np.int64)
+    last_daily_day = np.full(P, -10**6)
+    got = {key: np.zeros(P, dtype=bool) for key in rewards}
+    time_to_max = np.full((P, n_chars), np.nan)
+    latyao_bought = np.zeros(P, dtype=np.int64)
+
+    def unlock(key, cond):
+        new = cond & ~got[key]
+        got[key] |= new
+        coins[new] += rewards[key]
+
+    for day in range(D):
+        active = rng.random(P) < active_prob
+
+        # 🎁 ежедневный бонус: пропуск больше чем на день сбрасывает стрик
+        claim = active & (rng.random(P) < args.daily_prob)
+        gap = day - last_daily_day
+        streak = np.where(claim, np.where(gap <= 2, streak + 1, 1), streak)
+        last_daily_day = np.where(claim, day, last_daily_day)
+        coins += np.where(claim, daily[np.minimum(streak, len(daily) - 1)], 0)
+
+        for _ in range(S):
+            clicks = rng.poisson(clicks_per_day / S) * active
+            base = earn[earn_lvl]
+
+            # 🔥 Латяо: одна покупка покрывает клики за LATYAO_DURATION секунд
+            covered = np.zeros(P, dtype=np.int64)
+            if args.latyao_policy != "never":
+                per_latyao = latyao_duration * args.click_speed
+                want = np.ceil(clicks / per_latyao).astype(np.int64)
+                if args.latyao_policy == "profitable":
+                    # покупаем, только если удвоение окупает цену
+                    want = np.where(np.minimum(clicks, per_latyao) * base > latyao_cost, want, 0)
+                can = np.floor(coins / latyao_cost).astype(np.int64)
+                bought = np.minimum(want, can)
+                coins -= bought * latyao_cost
+                latyao_bought += bought
+                covered = np.minimum(clicks, (bought * per_latyao).astype(np.int64))
+                unlock("first_latyao", bought > 0)
+
+            # 💥 криты считаем отдельно для обычных кликов и кликов под Латяо
+            plain = clicks - covered
+            crits_plain = rng.binomial(plain, crit_chance)
+            crits_boost = rng.binomial(covered, crit_chance)
+            coins += base * (plain + 2 * covered + (crit_mult - 1) * (crits_plain + 2 * crits_boost))
+            unlock("coins_1000", coins >= 1000)
+            unlock("coins_10000", coins >= 10000)
+
+            # покупки: жадно, пока хватает денег
+            while True:
+                current = np.minimum((levels >= max_level).cumprod(axis=1).sum(axis=1), n_chars - 1)
+                cur_lvl = levels[everyone, current]
+                next_upgrade = upgrade_cost[earn_lvl]
+                next_level = level_cost[current, cur_lvl]
+                if args.buy_policy == "upgrades-first":
+                    buy_upgrade = coins >= next_upgrade
+                    buy_level = ~buy_upgrade & np.isinf(next_upgrade) & (coins >= next_level)
+                else:  # cheapest-first
+                    buy_upgrade = (next_upgrade <= next_level) & (coins >= next_upgrade)
+                    buy_level = (next_level < next_upgrade) & (coins >= next_level)
+                if not (buy_upgrade.any() or buy_level.any()):
+                    break
+                coins -= np.where(buy_upgrade, next_upgrade, 0) + np.where(buy_level, next_level, 0)
+                earn_lvl += buy_upgrade
+                levels[everyone[buy_level], current[buy_level]] += 1
+                maxed_now = buy_level & (levels[everyone, current] == max_level)
+                time_to_max[everyone[maxed_now], current[maxed_now]] = day + 1
+                unlock("first_max_char", maxed_now)
+
+    return {
+        "coins": coins,
+        "earn_lvl": earn_lvl,
+        "levels": levels,
+        "time_to_max": time_to_max,
+        "achievements": got,
+        "latyao_bought": latyao_bought,
+    }
+
+
+def report(game, args, result, elapsed):
+    player_days = args.players * args.days
+    print(f"Смоделировано {player_days:,} игроко-дней за {elapsed:.2f} с "
+          f"({player_days / elapsed:,.0f} в секунду)\n")
+
+    print("Время до максимума по персонажам (дни):")
+    ttm = result["time_to_max"]
+    for c, name in enumerate(game.CHARACTERS):
+        reached = ttm[:, c][~np.isnan(ttm[:, c])]
+        share = len(reached) / args.players
+        if len(reached):
+            p50, p90 = np.percentile(reached, [50, 90])
+            print(f"  {name:<8} докачали {share:6.1%}   медиана {p50:6.1f}   p90 {p90:6.1f}")
+        else:
+            print(f"  {name:<8} докачали {share:6.1%}")
+
+    coins = result["coins"]
+    p10, p50, p90, p99 = np.percentile(coins, [10, 50, 90, 99])
+    print("\nЖиркоины на балансе в конце:")
+    print(f"  среднее {coins.mean():,.0f}   p10 {p10:,.0f}   медиана {p50:,.0f}   "
+          f"p90 {p90:,.0f}   p99 {p99:,.0f}")
+
+    earn_lvl = result["earn_lvl"]
+    print(f"\nУлучшение заработка: медиана {np.median(earn_lvl):.0f}/{game.MAX_EARN_UPGRADE}, "
+          f"на максимуме {np.mean(earn_lvl == game.MAX_EARN_UPGRADE):.1%}")
+    print(f"Латяо: в среднем {result['latyao_bought'].mean():.1f} покупок на игрока")
+
+    print("\nДостижения:")
+    for key, got in result["achievements"].items():
+        print(f"  {game.ACHIEVEMENTS_DEFS[key]['title']:<18} {got.mean():6.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Симулятор экономики абу-бандитов")
+    parser.add_argument("--players", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sessions-per-day", type=int, default=4,
+                        help="сколько раз в день игрок заходит покликать и потратить монеты")
+    parser.add_argument("--clicks-mean", type=float, default=300, help="медиана кликов в день")
+    parser.add_argument("--clicks-sigma", type=float, default=0.8, help="разброс кликов (логнормальный)")
+    parser.add_argument("--click-speed", type=float, default=2, help="кликов в секунду во время игры")
+    parser.add_argument("--active-prob", type=float, default=0.7, help="шанс, что игрок зайдёт в день")
+    parser.add_argument("--daily-prob", type=float, default=0.8,
+                        help="шанс забрать ежедневный бонус, если зашёл")
+    parser.add_argument("--latyao-policy", choices=["never", "profitable", "always"], default="profitable")
+    parser.add_argument("--buy-policy", choices=["upgrades-first", "cheapest-first"], default="upgrades-first")
+
+    tuning = parser.add_argument_group("переопределение констант bot.py")
+    tuning.add_argument("--earn-upgrade-base-cost", type=int)
+    tuning.add_argument("--level-factor", type=float, help="LEVEL_COST_CHAR_FACTOR (сейчас 1.2)")
+    tuning.add_argument("--crit-chance", type=float)
+    tuning.add_argument("--crit-multiplier", type=int)
+    tuning.add_argument("--daily-base-reward", type=int)
+    tuning.add_argument("--daily-streak-bonus", type=int)
+    tuning.add_argument("--latyao-cost", type=int)
+    args = parser.parse_args()
+
+    with offline_game("sim") as game:
+        apply_overrides(game, args)
+        started = time.perf_counter()
+        result = simulate(game, args)
+        report(game, args, result, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()